@@ -2,9 +2,13 @@ import streamlit as st
 from supabase import create_client, Client
 import pandas as pd
 from fpdf import FPDF
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, time
+from zoneinfo import ZoneInfo
 import os
 import json
+import io
+import hashlib
+import bisect
 import unicodedata
 
 # ==========================================
@@ -87,6 +91,7 @@ LAB_NOMBRE = "Laboratorio de Análisis Clínicos Santa Fe"
 LAB_DIRECCION = "Calle Miguel Cabrera 409 D, Col. Centro, Oaxaca de Juárez, Oaxaca"
 LAB_CONTACTO = "Tel: 9511895316 | labclinicosantafe@gmail.com"
 LAB_LEYENDA_LEGAL = "Responsable Sanitario: QB. Olga Lidia Mendoza Velázquez. Cédula Prof: 1234567."
+LAB_ZONA_HORARIA = ZoneInfo("America/Mexico_City")
 
 # ==========================================
 # 🔽 CONFIGURACIÓN DE LISTAS ESTÁNDAR
@@ -135,6 +140,13 @@ def normalizar_texto(texto):
     if not isinstance(texto, str): return str(texto)
     return ''.join(c for c in unicodedata.normalize('NFD', texto) if unicodedata.category(c) != 'Mn').lower().strip()
 
+_OPCIONES_NORM = {col: {normalizar_texto(x): x for x in ops} for col, ops in OPCIONES_BASE.items()}
+
+def valor_oficial(col, valor):
+    """Escritura de OPCIONES_BASE que corresponde a 'valor' sin importar mayúsculas ni acentos."""
+    texto = str(valor).strip()
+    return _OPCIONES_NORM.get(col, {}).get(normalizar_texto(texto), texto)
+
 # --- FUNCIONES BASE DE DATOS (CRUD) ---
 def guardar_en_supabase(paciente, total, descuento_tipo):
     if not paciente:
@@ -213,6 +225,132 @@ def eliminar_estudio(id_estudio):
         st.error(f"Error eliminando estudio: {e}")
         return False
 
+# --- EXPORTACIÓN CONTABLE ---
+EXPORT_TAMANO_PAGINA = 500
+EXPORT_COLUMNAS = ["fecha", "id_cotizacion", "nombre_paciente", "tipo_descuento", "estado",
+                   "id_estudio", "nombre_estudio", "precio_publico", "descuento", "precio_neto"]
+
+def _limites_periodo(desde, hasta):
+    """Fechas -> medianoche en la hora local del laboratorio, no en UTC."""
+    return (datetime.combine(desde, time.min, tzinfo=LAB_ZONA_HORARIA).isoformat(),
+            datetime.combine(hasta, time.min, tzinfo=LAB_ZONA_HORARIA).isoformat())
+
+def _fecha_local(valor):
+    if not valor: return None
+    return datetime.fromisoformat(valor.replace('Z', '+00:00')).astimezone(LAB_ZONA_HORARIA)
+
+def contar_cotizaciones(desde, hasta):
+    """Cuántas cotizaciones hay en [desde, hasta); de paso verifica la conexión antes de exportar."""
+    inicio, fin = _limites_periodo(desde, hasta)
+    try:
+        r = supabase.table("cotizaciones").select("id", count="exact").gte("created_at", inicio).lt("created_at", fin).limit(1).execute()
+        return r.count or 0
+    except Exception as e:
+        st.error(f"Error: {e}")
+        return None
+
+def paginar_cotizaciones(desde, hasta, tamano=EXPORT_TAMANO_PAGINA):
+    """Recorre 'cotizaciones' en [desde, hasta) con cursor por llave (id > último), una página a la vez."""
+    inicio, fin = _limites_periodo(desde, hasta)
+    ultimo_id = None
+    while True:
+        q = supabase.table("cotizaciones").select("id, created_at, nombre_paciente, total, tipo_descuento, estado, items") \
+            .gte("created_at", inicio).lt("created_at", fin)
+        if ultimo_id is not None: q = q.gt("id", ultimo_id)
+        pagina = q.order("id").limit(tamano).execute().data
+        if not pagina: return
+        yield pagina
+        if len(pagina) < tamano: return
+        ultimo_id = pagina[-1]['id']
+
+def aplanar_cotizacion(cot):
+    """Una fila por estudio; el descuento se reparte proporcional al precio y el centavo
+    sobrante del redondeo va a la última línea para que los netos sumen el 'total' guardado."""
+    items = cot.get('items') or []
+    total = float(cot.get('total') or 0)
+    base = {
+        "fecha": _fecha_local(cot.get('created_at')),
+        "id_cotizacion": str(cot.get('id')),
+        "nombre_paciente": cot.get('nombre_paciente'),
+        "tipo_descuento": cot.get('tipo_descuento'),
+        "estado": cot.get('estado', 'Pendiente')
+    }
+    if not items:
+        # Cotización vacía: se conserva una línea para que no desaparezca del periodo
+        yield {**base, "id_estudio": "", "nombre_estudio": "", "precio_publico": 0.0, "descuento": 0.0, "precio_neto": round(total, 2)}
+        return
+    subtotal = sum(float(x.get('precio_publico', 0) or 0) for x in items)
+    desc_total = round(subtotal - total, 2)
+    desc_acumulado = 0.0
+    for idx, item in enumerate(items):
+        precio = float(item.get('precio_publico', 0) or 0)
+        if idx == len(items) - 1: desc = round(desc_total - desc_acumulado, 2)
+        else: desc = round(desc_total * precio / subtotal, 2) if subtotal else 0.0
+        desc_acumulado += desc
+        yield {
+            **base,
+            "id_estudio": str(item.get('id', '')),
+            "nombre_estudio": item.get('nombre_estudio'),
+            "precio_publico": precio,
+            "descuento": desc,
+            "precio_neto": round(precio - desc, 2)
+        }
+
+def _pagina_a_df(pagina):
+    df_pag = pd.DataFrame([f for cot in pagina for f in aplanar_cotizacion(cot)], columns=EXPORT_COLUMNAS)
+    df_pag['fecha'] = pd.to_datetime(df_pag['fecha'], utc=True).dt.tz_convert(LAB_ZONA_HORARIA)
+    return df_pag
+
+def exportar_csv(desde, hasta):
+    """Generador de bytes CSV; solo mantiene en memoria una página de cotizaciones."""
+    encabezado = True
+    for pagina in paginar_cotizaciones(desde, hasta):
+        df_pag = _pagina_a_df(pagina)
+        if df_pag.empty: continue
+        yield df_pag.to_csv(index=False, header=encabezado).encode('utf-8')
+        encabezado = False
+    if encabezado: yield (",".join(EXPORT_COLUMNAS) + "\n").encode('utf-8')
+
+class _SalidaIncremental(io.RawIOBase):
+    """Destino de escritura que se puede vaciar por partes sin perder la posición (Parquet la usa en el pie)."""
+    def __init__(self):
+        self._partes = []
+        self._pos = 0
+
+    def writable(self): return True
+
+    def write(self, b):
+        self._partes.append(bytes(b))
+        self._pos += len(b)
+        return len(b)
+
+    def tell(self): return self._pos
+
+    def vaciar(self):
+        datos = b''.join(self._partes)
+        self._partes = []
+        return datos
+
+def exportar_parquet(desde, hasta):
+    """Generador de bytes Parquet; cada página de cotizaciones se escribe como un row group."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    esquema = pa.schema([
+        ("fecha", pa.timestamp('us', tz='America/Mexico_City')), ("id_cotizacion", pa.string()), ("nombre_paciente", pa.string()),
+        ("tipo_descuento", pa.string()), ("estado", pa.string()), ("id_estudio", pa.string()),
+        ("nombre_estudio", pa.string()), ("precio_publico", pa.float64()),
+        ("descuento", pa.float64()), ("precio_neto", pa.float64())
+    ])
+    salida = _SalidaIncremental()
+    writer = pq.ParquetWriter(salida, esquema)
+    for pagina in paginar_cotizaciones(desde, hasta):
+        df_pag = _pagina_a_df(pagina)
+        if df_pag.empty: continue
+        writer.write_table(pa.Table.from_pandas(df_pag, schema=esquema, preserve_index=False))
+        yield salida.vaciar()
+    writer.close()
+    yield salida.vaciar()
+
 # --- MOTOR PDF ---
 def limpiar_texto(t):
     if not isinstance(t, str): return str(t)
@@ -285,19 +423,142 @@ def generar_pdf(paciente, items, subtotal, desc, total, tipo_desc, fecha_custom=
     pdf.cell(25, 10, f"${total:,.2f}", 1, 1, 'R')
     return pdf.output(dest='S').encode('latin-1')
 
+# --- LISTA DE PRECIOS (CATÁLOGO PDF) ---
+class PDFListaPrecios(PDF):
+    seccion = None
+
+    def header(self):
+        super().header()
+        if not self.seccion: return
+        self.set_fill_color(230, 240, 255)
+        self.set_font('Arial', 'B', 12)
+        self.cell(0, 9, limpiar_texto(f"  Lista de Precios - {self.seccion}"), 0, 1, 'L', 1)
+        self.ln(2)
+        self.set_fill_color(50, 50, 50)
+        self.set_text_color(255, 255, 255)
+        self.set_font('Arial', 'B', 9)
+        self.cell(95, 7, "Estudio / Servicio", 1, 0, 'C', 1)
+        self.cell(40, 7, "Muestra", 1, 0, 'C', 1)
+        self.cell(30, 7, "Entrega", 1, 0, 'C', 1)
+        self.cell(25, 7, "Precio", 1, 1, 'C', 1)
+        self.set_text_color(0, 0, 0)
+        self.set_font('Arial', '', 8)
+
+def secciones_lista_precios(df_cat):
+    """Agrupa el catálogo por lugar_proceso -> [(lugar, [(estudio, muestra, entrega, precio), ...])]."""
+    if df_cat.empty: return []
+    def _txt(col):
+        if col not in df_cat.columns: return ['-'] * len(df_cat)
+        return ['-' if v is None or pd.isna(v) or str(v).strip() in ('', 'nan') else str(v) for v in df_cat[col].tolist()]
+    if 'lugar_proceso' in df_cat.columns:
+        lugares = df_cat['lugar_proceso'].fillna('').astype(str).str.strip()
+        lugares = lugares.map({v: valor_oficial('lugar_proceso', v) for v in lugares.unique()}).replace('', 'Sin asignar')
+    else: lugares = pd.Series('Sin asignar', index=df_cat.index)
+    orden = [x for x in OPCIONES_BASE['lugar_proceso'] if x in set(lugares)] + sorted(set(lugares) - set(OPCIONES_BASE['lugar_proceso']))
+    precios = pd.to_numeric(df_cat['precio_publico'], errors='coerce').fillna(0).tolist() if 'precio_publico' in df_cat.columns else [0.0] * len(df_cat)
+    agrupado = {lugar: [] for lugar in orden}
+    for lugar, fila in zip(lugares.tolist(), zip(_txt('nombre_estudio'), _txt('tipo_muestra'), _txt('tiempo_entrega'), map(float, precios))):
+        agrupado[lugar].append(fila)
+    for filas in agrupado.values(): filas.sort(key=lambda f: normalizar_texto(f[0]))
+    return list(agrupado.items())
+
+@st.cache_resource
+def _cache_secciones_precios():
+    """lugar -> (huella, fecha, bytes). En cache_resource para sobrevivir a los st.cache_data.clear() de cada edición."""
+    return {}
+
+def renderizar_seccion_precios(lugar, huella, fecha, filas):
+    """PDF de una sola sección; solo se vuelve a dibujar si cambió la huella de sus filas o la fecha de vigencia."""
+    cache = _cache_secciones_precios()
+    previo = cache.get(lugar)
+    if previo and previo[0] == huella and previo[1] == fecha: return previo[2]
+    pdf = PDFListaPrecios()
+    pdf.seccion = lugar
+    pdf.set_auto_page_break(auto=True, margin=25)
+    pdf.add_page()
+    for nombre, muestra, entrega, precio in filas:
+        pdf.cell(95, 6, limpiar_texto(nombre)[:60], 1, 0, 'L')
+        pdf.cell(40, 6, limpiar_texto(muestra)[:24], 1, 0, 'L')
+        pdf.cell(30, 6, limpiar_texto(entrega)[:18], 1, 0, 'C')
+        pdf.cell(25, 6, f"${precio:,.2f}", 1, 1, 'R')
+    datos = pdf.output(dest='S').encode('latin-1')
+    cache[lugar] = (huella, fecha, datos)
+    return datos
+
+def generar_lista_precios(df_cat):
+    """Une las secciones cacheadas; solo se vuelven a dibujar las que cambiaron de contenido."""
+    from pypdf import PdfWriter
+    writer = PdfWriter()
+    fecha = datetime.now().strftime('%Y-%m-%d')
+    for lugar, filas in secciones_lista_precios(df_cat):
+        huella = hashlib.sha1(json.dumps(filas, ensure_ascii=False).encode('utf-8')).hexdigest()
+        writer.append(io.BytesIO(renderizar_seccion_precios(lugar, huella, fecha, filas)))
+    salida = io.BytesIO()
+    writer.write(salida)
+    return salida.getvalue()
+
+# --- ÍNDICE DE FACETAS ---
+FACETAS = {"lugar_proceso": "Filtrar Origen", "tipo_muestra": "Muestra", "temperatura": "Temperatura", "tiempo_entrega": "Entrega"}
+
+def construir_indice_facetas(df_cat):
+    """Precalcula por faceta y valor el conjunto de posiciones de fila, más los precios ordenados."""
+    facetas = {}
+    for col in FACETAS:
+        grupos = {}
+        if col in df_cat.columns:
+            valores = df_cat[col].tolist()
+            oficiales = {v: valor_oficial(col, v) for v in set(valores) if v is not None and not pd.isna(v) and str(v).strip() != ''}
+            for pos, val in enumerate(valores):
+                if val in oficiales: grupos.setdefault(oficiales[val], set()).add(pos)
+        facetas[col] = {k: frozenset(v) for k, v in grupos.items()}
+    if 'precio_publico' in df_cat.columns: precios = pd.to_numeric(df_cat['precio_publico'], errors='coerce').fillna(0).tolist()
+    else: precios = [0.0] * len(df_cat)
+    orden = sorted(range(len(precios)), key=precios.__getitem__)
+    return {
+        "todos": frozenset(range(len(df_cat))),
+        "facetas": facetas,
+        "precios": [float(precios[i]) for i in orden],
+        "orden_precios": orden
+    }
+
+def filtrar_por_facetas(indice, seleccion, rango_precio=None, ids_busqueda=None):
+    """Intersecta los conjuntos de cada faceta elegida ('Todos' = sin filtro), el rango de precio
+    y, si hay texto buscado, las filas que coinciden con él."""
+    ids = indice["todos"] if ids_busqueda is None else ids_busqueda
+    for col, valor in seleccion.items():
+        if valor != "Todos": ids = ids & indice["facetas"][col].get(valor, frozenset())
+    if rango_precio:
+        lo = bisect.bisect_left(indice["precios"], rango_precio[0])
+        hi = bisect.bisect_right(indice["precios"], rango_precio[1])
+        ids = ids & frozenset(indice["orden_precios"][lo:hi])
+    return ids
+
+def conteos_faceta(indice, seleccion, col, rango_precio=None, ids_busqueda=None):
+    """Conteo por valor de una faceta, aplicando el resto de los filtros activos (búsqueda incluida)."""
+    base = filtrar_por_facetas(indice, {k: v for k, v in seleccion.items() if k != col}, rango_precio, ids_busqueda)
+    return {valor: len(ids & base) for valor, ids in indice["facetas"][col].items()}
+
+def selector_faceta(contenedor, indice, seleccion, rango_precio, ids_busqueda, col):
+    key = f"faceta_{col}"
+    conteos = conteos_faceta(indice, seleccion, col, rango_precio, ids_busqueda)
+    opciones = ["Todos"] + sorted(conteos, key=str)
+    if st.session_state.get(key, "Todos") not in opciones: st.session_state[key] = "Todos"
+    return contenedor.selectbox(FACETAS[col], opciones, key=key, format_func=lambda v: v if v == "Todos" else f"{v} ({conteos.get(v, 0)})")
+
 # --- CARGA DATOS ---
 @st.cache_data(ttl=600)
 def get_data():
-    if not supabase: return pd.DataFrame()
+    """Catálogo y su índice de facetas; se cachean juntos para que las posiciones de fila coincidan."""
+    if not supabase: return pd.DataFrame(), None
     r = supabase.table("catalogo_servicios").select("*").execute()
     df = pd.DataFrame(r.data)
     if not df.empty:
         if 'lugar_proceso' in df.columns:
             df['lugar_proceso'] = df['lugar_proceso'].fillna('').astype(str).str.strip()
         df['search_index'] = df.apply(lambda row: normalizar_texto(f"{row['nombre_estudio']}"), axis=1)
-    return df
+    return df, construir_indice_facetas(df)
 
-df = get_data()
+df, indice = get_data()
 
 if 'carrito' not in st.session_state: st.session_state['carrito'] = []
 
@@ -452,17 +713,40 @@ if menu_seleccionado == "📝 Cotizador y Catálogo":
     with col_catalogo:
         st.subheader("📂 Catálogo")
         c1, c2 = st.columns([1, 2])
-        opciones_lab = ["Todos"]
-        if not df.empty and 'lugar_proceso' in df.columns: opciones_lab += sorted(df['lugar_proceso'].unique().tolist())
-        filtro_lab = c1.selectbox("Filtrar Origen", opciones_lab)
         busqueda = c2.text_input("🔍 Buscar...", placeholder="Escribe nombre del estudio...")
 
-        df_ver = df.copy() if not df.empty else pd.DataFrame()
-        if not df_ver.empty:
-            if filtro_lab != "Todos": df_ver = df_ver[df_ver['lugar_proceso'] == filtro_lab]
+        df_ver = pd.DataFrame()
+        if not df.empty:
+            # Los valores vigentes de los widgets se leen antes de dibujarlos para calcular los conteos cruzados
+            seleccion = {col: st.session_state.get(f"faceta_{col}", "Todos") for col in FACETAS}
+            precio_min, precio_max = (indice["precios"][0], indice["precios"][-1]) if indice["precios"] else (0.0, 0.0)
+            # Se siembra el rango completo antes de crear el slider para que sea de dos extremos desde el primer run
+            rango = st.session_state.get("faceta_precio")
+            if not isinstance(rango, (tuple, list)) or len(rango) != 2 or not (precio_min <= rango[0] <= rango[1] <= precio_max):
+                rango = st.session_state["faceta_precio"] = (precio_min, precio_max)
+            rango_activo = rango if rango != (precio_min, precio_max) else None
+            # La búsqueda por nombre se vuelve un conjunto de filas para que los conteos también la respeten
+            ids_busqueda = None
             if busqueda:
-                q = normalizar_texto(busqueda)
-                df_ver = df_ver[df_ver['search_index'].str.contains(q)]
+                coincide = df['search_index'].str.contains(normalizar_texto(busqueda), regex=False).tolist()
+                ids_busqueda = frozenset(pos for pos, ok in enumerate(coincide) if ok)
+
+            seleccion["lugar_proceso"] = selector_faceta(c1, indice, seleccion, rango_activo, ids_busqueda, "lugar_proceso")
+            with st.expander("⚙️ Más filtros"):
+                f1, f2, f3 = st.columns(3)
+                for contenedor, col in zip([f1, f2, f3], ["tipo_muestra", "temperatura", "tiempo_entrega"]):
+                    seleccion[col] = selector_faceta(contenedor, indice, seleccion, rango_activo, ids_busqueda, col)
+                if precio_min < precio_max:
+                    rango = st.slider("Rango de precio:", min_value=precio_min, max_value=precio_max, key="faceta_precio", format="$%.2f")
+                    rango_activo = rango if rango != (precio_min, precio_max) else None
+
+            ids = filtrar_por_facetas(indice, seleccion, rango_activo, ids_busqueda)
+            df_ver = df.iloc[sorted(ids)]
+
+        if not df.empty and st.button("📚 Generar Lista de Precios (PDF)"):
+            with st.spinner("Generando lista de precios..."):
+                lista_pdf = generar_lista_precios(df)
+            st.download_button("📄 Descargar Lista de Precios", data=lista_pdf, file_name=f"Lista_Precios_{datetime.now():%Y%m%d}.pdf", mime="application/pdf")
         
         st.divider()
         
@@ -563,6 +847,26 @@ if menu_seleccionado == "📝 Cotizador y Catálogo":
 elif menu_seleccionado == "🗄️ Historial Guardado":
     st.title("🗄️ Historial y Control de Estatus")
     if st.button("🔄 Actualizar Tabla"): st.rerun()
+    with st.expander("📤 Exportar para Contabilidad"):
+        hoy = datetime.now(LAB_ZONA_HORARIA).date()
+        c1, c2 = st.columns([2, 1])
+        rango = c1.date_input("Periodo:", value=(hoy.replace(day=1), hoy), format="DD/MM/YYYY")
+        formato = c2.radio("Formato:", ["CSV", "Parquet"], horizontal=True)
+        num_cot = None
+        if not isinstance(rango, (list, tuple)) or len(rango) != 2: st.info("Selecciona fecha inicial y final.")
+        else:
+            desde, hasta = rango[0], rango[1] + timedelta(days=1)
+            num_cot = contar_cotizaciones(desde, hasta)
+        if num_cot is not None:
+            st.caption(f"{num_cot} cotizaciones en el periodo.")
+            exportador = exportar_csv if formato == "CSV" else exportar_parquet
+            ext = "csv" if formato == "CSV" else "parquet"
+            mime = "text/csv" if formato == "CSV" else "application/octet-stream"
+            # La consulta se difiere al clic. Los generadores leen página por página, pero
+            # download_button junta el archivo completo en memoria antes de enviarlo.
+            # El conteo de arriba valida la conexión: si falla, no se ofrece la descarga.
+            st.download_button(f"📥 Descargar {formato}", data=lambda: b"".join(exportador(desde, hasta)),
+                               file_name=f"Cotizaciones_{rango[0]:%Y%m%d}_{rango[1]:%Y%m%d}.{ext}", mime=mime)
     historial = obtener_historial()
     if not historial: st.info("No hay cotizaciones.")
     else: